@@ -0,0 +1,36 @@
+from typing import Dict, List, Optional, Tuple
+import threading
+from langchain_community.utilities import SQLDatabase
+
+class CachedSQLDatabase(SQLDatabase):
+    """
+    SQLDatabase that remembers table info (DDL plus sample rows).
+    The agent's schema tool asks for it on nearly every query, and each request
+    otherwise re-runs the sample-row SELECTs; call clear_table_info_cache()
+    after schema changes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._table_info_cache: Dict[Tuple[Optional[Tuple[str, ...]], bool], str] = {}
+        self._table_info_lock = threading.Lock()
+
+    def get_table_info(self, table_names: Optional[List[str]] = None, get_col_comments: bool = False) -> str:
+        """Get table info, computing it once per set of tables and comment setting"""
+        key = (None if table_names is None else tuple(sorted(table_names)), get_col_comments)
+        with self._table_info_lock:
+            table_info = self._table_info_cache.get(key)
+        if table_info is None:
+            # Only pass the flag when set, for SQLDatabase versions that predate it
+            if get_col_comments:
+                table_info = super().get_table_info(table_names, get_col_comments=True)
+            else:
+                table_info = super().get_table_info(table_names)
+            with self._table_info_lock:
+                self._table_info_cache[key] = table_info
+        return table_info
+
+    def clear_table_info_cache(self) -> None:
+        """Forget cached table info so it is read from the database again"""
+        with self._table_info_lock:
+            self._table_info_cache.clear()
@@ -0,0 +1,113 @@
+from collections import deque
+from typing import TYPE_CHECKING, Deque, List
+import re
+
+# langchain_core is imported when messages are built, keeping this module cheap to import
+if TYPE_CHECKING:
+    from langchain_core.messages import BaseMessage
+
+# Roughly the first sentence of a message, used when folding it into the summary
+_FIRST_SENTENCE = re.compile(r"^(.+?[.!?])(?:\s|$)", re.DOTALL)
+
+class BoundedChatMemory:
+    """Chat history with a sliding window of recent messages and a running summary of older ones"""
+
+    def __init__(
+        self,
+        max_messages: int = 10,
+        context_window: int = 4000,
+        max_summary_chars: int = 2000,
+        max_fact_chars: int = 200
+    ):
+        """
+        max_messages: most recent messages kept verbatim
+        context_window: token budget for the verbatim window; older messages are
+            folded into the summary once the window passes 80% of it
+        max_summary_chars: the summary keeps only its most recent text beyond this
+        max_fact_chars: longest excerpt kept from each folded message
+        """
+        self.max_messages = max_messages
+        self.context_window = context_window
+        self.max_summary_chars = max_summary_chars
+        self.max_fact_chars = max_fact_chars
+        self._recent: "Deque[BaseMessage]" = deque()
+        self._summary = ""
+
+    @staticmethod
+    def _estimate_tokens(message: "BaseMessage") -> int:
+        """Estimate tokens with the ~4 characters per token heuristic"""
+        return len(str(message.content)) // 4
+
+    def _fold_into_summary(self, message: "BaseMessage") -> None:
+        """Append the leading sentence of an evicted message to the summary"""
+        text = " ".join(str(message.content).split())
+        if not text:
+            return
+        match = _FIRST_SENTENCE.match(text)
+        fact = (match.group(1) if match else text)[:self.max_fact_chars]
+        role = "User" if message.type == "human" else "Assistant"
+        self._summary = f"{self._summary}\n{role}: {fact}".strip()[-self.max_summary_chars:]
+
+    def _trim(self) -> None:
+        """Fold the oldest messages into the summary until the window fits its budget"""
+        budget = 0.8 * self.context_window
+        while len(self._recent) > 1 and (
+            len(self._recent) > self.max_messages
+            or sum(self._estimate_tokens(m) for m in self._recent) > budget
+        ):
+            self._fold_into_summary(self._recent.popleft())
+
+    def add_message(self, message: "BaseMessage") -> None:
+        """Add a message to the history"""
+        self._recent.append(message)
+        self._trim()
+
+    def add_user_message(self, content: str) -> None:
+        from langchain_core.messages import HumanMessage
+
+        self.add_message(HumanMessage(content=content))
+
+    def add_ai_message(self, content: str) -> None:
+        from langchain_core.messages import AIMessage
+
+        self.add_message(AIMessage(content=content))
+
+    def clear(self) -> None:
+        """Forget the whole conversation"""
+        self._recent.clear()
+        self._summary = ""
+
+    @property
+    def summary(self) -> str:
+        return self._summary
+
+    def _summary_messages(self) -> List["BaseMessage"]:
+        """The summary of older turns as a system message, if there is one"""
+        if not self._summary:
+            return []
+        from langchain_core.messages import SystemMessage
+
+        return [SystemMessage(content=f"Summary of the earlier conversation:\n{self._summary}")]
+
+    @property
+    def messages(self) -> List["BaseMessage"]:
+        """Summary of older turns (if any) followed by the recent messages"""
+        history = self._summary_messages()
+        history.extend(self._recent)
+        return history
+
+    def dialogue(self, max_chars: int = 500) -> List["BaseMessage"]:
+        """
+        Like messages, but only user turns and final answers, each cut to max_chars.
+        Tool calls and observations (schemas, result sets) are left out so the
+        agent doesn't re-read them on every turn.
+        """
+        history = self._summary_messages()
+        for message in self._recent:
+            if message.type not in ("human", "ai") or getattr(message, "tool_calls", None):
+                continue
+            content = str(message.content)
+            if len(content) > max_chars:
+                message = message.__class__(content=content[:max_chars])
+            history.append(message)
+        return history
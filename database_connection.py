@@ -1,85 +1,297 @@
-from typing import Dict, Optional
-import psycopg2
-import pymysql
-from pymongo import MongoClient
-from pydantic import BaseModel
+from collections import OrderedDict, defaultdict
+from functools import lru_cache
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+import asyncio
+import logging
+import random
+import socket
+import ssl
+import time
+from pydantic import BaseModel, ConfigDict
 from fastapi import HTTPException
 
+if TYPE_CHECKING:
+    import asyncpg
+
+logger = logging.getLogger(__name__)
+
 class SSLConfig(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     rejectUnauthorized: bool = False
     sslmode: str = "require"
 
 class DatabaseConnection(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     type: str
     host: str
-    port: str
+    port: int
     database_name: str
     username: str
     password: str
     ssl: Optional[SSLConfig] = None
 
+T = TypeVar("T")
+
+# Database drivers, imported on first use so a deployment only loads the ones it tests
+_asyncpg = None
+_aiomysql = None
+_motor_asyncio = None
+_pymongo_errors = None
+
+def _import_asyncpg():
+    global _asyncpg
+    if _asyncpg is None:
+        import asyncpg as _asyncpg
+    return _asyncpg
+
+def _import_aiomysql():
+    global _aiomysql
+    if _aiomysql is None:
+        import aiomysql as _aiomysql
+    return _aiomysql
+
+def _import_motor():
+    global _motor_asyncio, _pymongo_errors
+    if _motor_asyncio is None:
+        import pymongo.errors as _pymongo_errors
+        import motor.motor_asyncio as _motor_asyncio
+    return _motor_asyncio
+
+# Upper bound on simultaneous outbound connect attempts across all connection tests
+_CONNECT_SEMAPHORE = asyncio.Semaphore(16)
+
+# MySQL client error code for "lost connection"; 2003 ("can't connect") is left out
+# because it also covers refused and timed-out connects
+_TRANSIENT_MYSQL_ERRORS = (2013,)
+
+def _is_transient_error(error: Exception) -> bool:
+    """
+    Check whether a connection error may succeed on a later attempt.
+    Only dropped connections are retried: timeouts already waited the full
+    connect timeout, and refused or unresolvable hosts won't change within seconds.
+    """
+    if isinstance(error, (socket.gaierror, ConnectionRefusedError, asyncio.TimeoutError)):
+        return False
+    if _asyncpg is not None and isinstance(error, _asyncpg.PostgresError):
+        # Authentication and missing-database errors fall through as permanent
+        return isinstance(error, (_asyncpg.PostgresConnectionError, _asyncpg.CannotConnectNowError))
+    if _aiomysql is not None and isinstance(error, _aiomysql.OperationalError):
+        return bool(error.args) and error.args[0] in _TRANSIENT_MYSQL_ERRORS
+    if _pymongo_errors is not None and isinstance(error, _pymongo_errors.AutoReconnect):
+        return not isinstance(error, (_pymongo_errors.ServerSelectionTimeoutError, _pymongo_errors.NetworkTimeout))
+    return isinstance(error, (ConnectionResetError, ConnectionAbortedError, BrokenPipeError))
+
+async def _connect_with_backoff(
+    coro_factory: Callable[[], Awaitable[T]],
+    *,
+    max_retries: int = 3,
+    base: float = 1.0,
+    cap: float = 30.0,
+    jitter: float = 0.5
+) -> T:
+    """
+    Await coro_factory(), retrying transient failures with exponential backoff and jitter.
+    Each attempt holds a connect slot; backoff sleeps do not.
+    """
+    attempt = 0
+    while True:
+        try:
+            async with _CONNECT_SEMAPHORE:
+                return await coro_factory()
+        except Exception as e:
+            if attempt >= max_retries or not _is_transient_error(e):
+                raise
+            delay = min(cap, base * 2 ** attempt) * (1 + random.uniform(-jitter, jitter))
+            logger.warning("Transient connection error (%s), retrying in %.2fs", type(e).__name__, delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+@lru_cache(maxsize=None)
+def _get_ssl_context(verify: bool) -> ssl.SSLContext:
+    """
+    Return a shared SSL context so CA certificates are loaded once per process
+    """
+    ssl_context = ssl.create_default_context()
+    if not verify:
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+    return ssl_context
+
+# PostgreSQL pools reused across connection tests, keyed by endpoint and credentials.
+# Least recently used pools are closed beyond the size limit, since every pool holds
+# a live server connection and the endpoints come from callers.
+_POSTGRESQL_POOL_MAX_SIZE = 32
+_postgresql_pools: "OrderedDict[tuple, asyncpg.Pool]" = OrderedDict()
+_postgresql_pool_locks: Dict[tuple, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+async def _get_postgresql_pool(conn_params: Dict) -> "asyncpg.Pool":
+    """
+    Return the pool for the given connection parameters, creating it on first use
+    """
+    key = (
+        conn_params["host"],
+        conn_params["port"],
+        conn_params["database"],
+        conn_params["user"],
+        conn_params["password"]
+    )
+    evicted = []
+    async with _postgresql_pool_locks[key]:
+        pool = _postgresql_pools.get(key)
+        if pool is None:
+            asyncpg = _import_asyncpg()
+            try:
+                pool = await _connect_with_backoff(lambda: asyncpg.create_pool(
+                    min_size=1,
+                    max_size=4,
+                    max_inactive_connection_lifetime=300,
+                    **conn_params
+                ))
+            except Exception:
+                _postgresql_pool_locks.pop(key, None)
+                raise
+
+            existing = _postgresql_pools.get(key)
+            if existing is not None:
+                # Created concurrently under a lock that was evicted meanwhile; keep the first
+                evicted.append(pool)
+                pool = existing
+            else:
+                _postgresql_pools[key] = pool
+                while len(_postgresql_pools) > _POSTGRESQL_POOL_MAX_SIZE:
+                    stale_key, stale_pool = _postgresql_pools.popitem(last=False)
+                    _postgresql_pool_locks.pop(stale_key, None)
+                    evicted.append(stale_pool)
+        _postgresql_pools.move_to_end(key)
+
+    await asyncio.gather(*(stale_pool.close() for stale_pool in evicted))
+    return pool
+
+async def close_postgresql_pools() -> None:
+    """
+    Close all cached PostgreSQL pools
+    """
+    pools = list(_postgresql_pools.values())
+    _postgresql_pools.clear()
+    _postgresql_pool_locks.clear()
+    await asyncio.gather(*(pool.close() for pool in pools))
+
+# Recent successful test results, so status polling doesn't re-probe the database.
+# Keyed by the (frozen, hashable) connection model, which includes the password.
+_RECENT_RESULT_TTL = 5.0
+_RECENT_RESULT_MAX_SIZE = 256
+_recent_results: "OrderedDict[DatabaseConnection, Tuple[float, Dict]]" = OrderedDict()
+
 async def test_connection(connection_data: DatabaseConnection) -> Dict:
     """
     Test database connection based on the provided credentials
     """
+    cached = _recent_results.get(connection_data)
+    if cached is not None and time.monotonic() - cached[0] < _RECENT_RESULT_TTL:
+        return dict(cached[1])
+
     try:
-        if connection_data.type.lower() == "postgresql":
-            return await test_postgresql_connection(connection_data)
-        elif connection_data.type.lower() == "mysql":
-            return await test_mysql_connection(connection_data)
-        elif connection_data.type.lower() == "mongodb":
-            return await test_mongodb_connection(connection_data)
-        else:
+        handler = _CONNECTION_TESTERS.get(connection_data.type.lower())
+        if handler is None:
             raise HTTPException(
                 status_code=400,
                 detail=f"Unsupported database type: {connection_data.type}"
             )
+        result = await handler(connection_data)
     except Exception as e:
         raise HTTPException(
             status_code=400,
             detail=f"Connection failed: {str(e)}"
         )
 
+    _recent_results[connection_data] = (time.monotonic(), result)
+    _recent_results.move_to_end(connection_data)
+    while len(_recent_results) > _RECENT_RESULT_MAX_SIZE:
+        _recent_results.popitem(last=False)
+    return dict(result)
+
+async def test_connections(connections: List[DatabaseConnection]) -> List[Dict]:
+    """
+    Test several database connections concurrently.
+    Failures are reported per entry instead of failing the whole batch.
+    """
+    results = await asyncio.gather(
+        *(test_connection(connection_data) for connection_data in connections),
+        return_exceptions=True
+    )
+
+    formatted_results = []
+    for result in results:
+        if isinstance(result, HTTPException):
+            formatted_results.append({
+                "status": "error",
+                "status_code": result.status_code,
+                "message": result.detail
+            })
+        elif isinstance(result, Exception):
+            formatted_results.append({
+                "status": "error",
+                "status_code": 400,
+                "message": f"Connection failed: {str(result)}"
+            })
+        else:
+            formatted_results.append(result)
+    return formatted_results
+
+def _format_postgresql_version(server_version) -> str:
+    """
+    Format an asyncpg ServerVersion, e.g. "PostgreSQL 15.4" or "PostgreSQL 9.6.24"
+    """
+    if server_version.major >= 10:
+        return f"PostgreSQL {server_version.major}.{server_version.minor}"
+    return f"PostgreSQL {server_version.major}.{server_version.minor}.{server_version.micro}"
+
 async def test_postgresql_connection(connection_data: DatabaseConnection) -> Dict:
     """
     Test PostgreSQL connection with SSL support
     """
+    asyncpg = _import_asyncpg()
     try:
-        # Build connection string with SSL parameters
+        # Build connection parameters with SSL
         conn_params = {
             "host": connection_data.host,
             "port": connection_data.port,
             "database": connection_data.database_name,
             "user": connection_data.username,
             "password": connection_data.password,
-            "sslmode": "require",  # Required for Render.com
-            "connect_timeout": 10   # Add timeout
+            "ssl": _get_ssl_context(verify=False),  # Required for Render.com
+            "timeout": 10   # Add timeout
         }
 
-        print(f"Attempting PostgreSQL connection with params: {conn_params}")
+        logger.debug(
+            "Attempting PostgreSQL connection to %s:%s db=%s",
+            connection_data.host, connection_data.port, connection_data.database_name
+        )
         
         # Try to establish connection
         try:
-            conn = psycopg2.connect(**conn_params)
+            pool = await _get_postgresql_pool(conn_params)
             
-            # Test the connection by executing a simple query
-            with conn.cursor() as cur:
-                cur.execute('SELECT version()')
-                version = cur.fetchone()[0]
-                print(f"Successfully connected to PostgreSQL: {version}")
-            
-            conn.close()
+            # Test the connection by executing a simple query; the server
+            # version comes from the startup message without a round-trip
+            async with pool.acquire() as conn:
+                await conn.execute('SELECT 1')
+                version = _format_postgresql_version(conn.get_server_version())
+                logger.debug("Successfully connected to PostgreSQL: %s", version)
+
             return {
                 "status": "success",
                 "message": "Successfully connected to PostgreSQL database",
                 "version": version
             }
-        except psycopg2.OperationalError as e:
-            error_msg = str(e).strip()
-            print(f"PostgreSQL OperationalError: {error_msg}")
+        except (asyncpg.PostgresError, OSError, asyncio.TimeoutError) as e:
+            error_msg = str(e).strip() or type(e).__name__
+            logger.error("PostgreSQL connection error: %s", error_msg)
             
             # Provide more specific error messages
-            if "password authentication failed" in error_msg:
+            if isinstance(e, asyncpg.InvalidPasswordError) or "password authentication failed" in error_msg:
                 raise HTTPException(
                     status_code=400,
                     detail="Authentication failed: Please check your username and password"
@@ -89,12 +301,12 @@ async def test_postgresql_connection(connection_data: DatabaseConnection) -> Dic
                     status_code=400,
                     detail="SSL connection required. The database requires a secure connection"
                 )
-            elif "connection timed out" in error_msg:
+            elif isinstance(e, asyncio.TimeoutError) or "timed out" in error_msg:
                 raise HTTPException(
                     status_code=400,
                     detail="Connection timed out: Please check your host and port settings"
                 )
-            elif "database" in error_msg and "does not exist" in error_msg:
+            elif isinstance(e, asyncpg.InvalidCatalogNameError) or ("database" in error_msg and "does not exist" in error_msg):
                 raise HTTPException(
                     status_code=400,
                     detail="Database does not exist: Please check your database name"
@@ -107,7 +319,7 @@ async def test_postgresql_connection(connection_data: DatabaseConnection) -> Dic
                 
     except Exception as e:
         error_msg = str(e)
-        print(f"PostgreSQL connection error: {error_msg}")
+        logger.error("PostgreSQL connection error: %s", error_msg)
         
         raise HTTPException(
             status_code=400,
@@ -121,19 +333,19 @@ async def test_mysql_connection(connection_data: DatabaseConnection) -> Dict:
     try:
         conn_params = {
             "host": connection_data.host,
-            "port": int(connection_data.port),
-            "database": connection_data.database_name,
+            "port": connection_data.port,
+            "db": connection_data.database_name,
             "user": connection_data.username,
             "password": connection_data.password,
+            "connect_timeout": 10
         }
 
         # Add SSL parameters if SSL is configured
         if connection_data.ssl:
-            conn_params["ssl"] = {}
-            if not connection_data.ssl.rejectUnauthorized:
-                conn_params["ssl"]["verify_cert"] = False
+            conn_params["ssl"] = _get_ssl_context(connection_data.ssl.rejectUnauthorized)
 
-        conn = pymysql.connect(**conn_params)
+        aiomysql = _import_aiomysql()
+        conn = await _connect_with_backoff(lambda: aiomysql.connect(**conn_params))
         conn.close()
         return {"status": "success", "message": "Successfully connected to MySQL database"}
     except Exception as e:
@@ -149,7 +361,7 @@ async def test_mongodb_connection(connection_data: DatabaseConnection) -> Dict:
     try:
         conn_params = {
             "host": connection_data.host,
-            "port": int(connection_data.port),
+            "port": connection_data.port,
             "username": connection_data.username,
             "password": connection_data.password,
             "serverSelectionTimeoutMS": 5000  # 5 second timeout
@@ -161,13 +373,23 @@ async def test_mongodb_connection(connection_data: DatabaseConnection) -> Dict:
             if not connection_data.ssl.rejectUnauthorized:
                 conn_params["tlsAllowInvalidCertificates"] = True
 
-        client = MongoClient(**conn_params)
-        # Test connection by listing database names
-        client.list_database_names()
-        client.close()
+        motor_asyncio = _import_motor()
+        client = motor_asyncio.AsyncIOMotorClient(**conn_params)
+        try:
+            # Test connection by listing database names
+            await _connect_with_backoff(client.list_database_names)
+        finally:
+            client.close()
         return {"status": "success", "message": "Successfully connected to MongoDB database"}
     except Exception as e:
         raise HTTPException(
             status_code=400,
             detail=f"MongoDB connection failed: {str(e)}"
-        ) 
\ No newline at end of file
+        )
+
+# Connection test coroutines keyed by lower-cased database type
+_CONNECTION_TESTERS = {
+    "postgresql": test_postgresql_connection,
+    "mysql": test_mysql_connection,
+    "mongodb": test_mongodb_connection
+}
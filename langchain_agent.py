@@ -1,112 +1,331 @@
-from langchain_community.agent_toolkits.sql.base import create_sql_agent
-from langchain_community.agent_toolkits.sql.toolkit import SQLDatabaseToolkit
-from langchain_community.utilities import SQLDatabase
-from langchain_openai import ChatOpenAI
-from langchain.memory import ConversationBufferMemory
 from dotenv import load_dotenv
+from chat_memory import BoundedChatMemory
+from collections import OrderedDict
+import asyncio
+import hashlib
+import logging
 import os
-import json
+import threading
+import time
+from typing import TYPE_CHECKING, List, Optional, Tuple
 from database_connection import DatabaseConnection
 
+# LangChain and OpenAI pull in hundreds of modules; they are imported on first use
+if TYPE_CHECKING:
+    from langchain.agents import AgentExecutor
+    from langchain_community.agent_toolkits.sql.toolkit import SQLDatabaseToolkit
+    from langchain_community.utilities import SQLDatabase
+    from langchain_openai import ChatOpenAI
+
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Stream the agent's intermediate reasoning to stdout (AGENT_VERBOSE=1)
+AGENT_VERBOSE = os.getenv("AGENT_VERBOSE") == "1"
+
+# Connection pool settings for the SQLAlchemy engines behind SQLDatabase
+SQL_ENGINE_ARGS = {
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_pre_ping": True,
+    "pool_recycle": 1800
+}
+
+# SQLAlchemy driver names keyed by lower-cased database type
+SQLALCHEMY_DRIVERS = {
+    "postgresql": "postgresql",
+    "mysql": "mysql+pymysql"
+}
+
+_llm: Optional["ChatOpenAI"] = None
+_llm_lock = threading.Lock()
+
+def get_llm() -> "ChatOpenAI":
+    """Return the process-wide chat model, so all agents share one OpenAI HTTP connection pool"""
+    global _llm
+    if _llm is None:
+        with _llm_lock:
+            if _llm is None:
+                import httpx
+                from langchain_openai import ChatOpenAI
+
+                # HTTP/2 multiplexes the agent's several LLM calls per query over
+                # one kept-alive TLS connection instead of opening new ones
+                limits = httpx.Limits(max_keepalive_connections=20, max_connections=100)
+                _llm = ChatOpenAI(
+                    temperature=0,
+                    model_name="gpt-3.5-turbo",
+                    openai_api_key=os.getenv("OPENAI_API_KEY"),
+                    http_client=httpx.Client(http2=True, limits=limits),
+                    http_async_client=httpx.AsyncClient(http2=True, limits=limits)
+                )
+    return _llm
+
 class LangChainAgent:
+    # Maximum number of connections whose database, toolkit and agent are kept
+    AGENT_CACHE_SIZE = 32
+    # Successful results are reused for repeated questions (pass fresh=True to bypass)
+    RESULT_CACHE_SIZE = 256
+    RESULT_CACHE_TTL = 3600
+
     def __init__(self):
         """Initialize the LangChain agent with OpenAI model"""
         # Initialize the language model
-        self.llm = ChatOpenAI(
-            temperature=0,
-            model_name="gpt-3.5-turbo",
-            openai_api_key=os.getenv("OPENAI_API_KEY")
-        )
+        self.llm = get_llm()
 
         # Initialize memory
-        self.memory = ConversationBufferMemory(
-            memory_key="chat_history",
-            return_messages=True
-        )
+        self.memory = BoundedChatMemory()
+
+        # (SQLDatabase, toolkit, agent) per connection, keyed by a hash of the
+        # connection URI so credentials never appear in cache keys or logs
+        self._agent_cache: "OrderedDict[str, Tuple[SQLDatabase, SQLDatabaseToolkit, AgentExecutor]]" = OrderedDict()
+        self._agent_cache_lock = threading.Lock()
+
+        # (connection key, normalized query, include_reasoning) -> (stored at, result)
+        self._result_cache: "OrderedDict[Tuple[str, str, bool], Tuple[float, dict]]" = OrderedDict()
+        self._result_cache_lock = threading.Lock()
 
     def get_connection_uri(self, connection: DatabaseConnection) -> str:
         """Generate a database URI from connection details"""
-        if connection.type.lower() == "postgresql":
-            return f"postgresql://{connection.username}:{connection.password}@{connection.host}:{connection.port}/{connection.database_name}"
-        elif connection.type.lower() == "mysql":
-            return f"mysql+pymysql://{connection.username}:{connection.password}@{connection.host}:{connection.port}/{connection.database_name}"
-        else:
+        drivername = SQLALCHEMY_DRIVERS.get(connection.type.lower())
+        if drivername is None:
             raise ValueError(f"Unsupported database type: {connection.type}")
+        from sqlalchemy.engine import URL
+
+        # URL escapes credentials containing @, /, : or %
+        return URL.create(
+            drivername,
+            username=connection.username,
+            password=connection.password,
+            host=connection.host,
+            port=connection.port,
+            database=connection.database_name
+        ).render_as_string(hide_password=False)
+
+    def _cache_key(self, connection: DatabaseConnection) -> str:
+        """Hash the connection URI for use as a cache key"""
+        return hashlib.sha256(self.get_connection_uri(connection).encode()).hexdigest()
+
+    def get_agent(self, connection: DatabaseConnection) -> "AgentExecutor":
+        """Return the SQL agent for a connection, reflecting the schema only on first use"""
+        key = self._cache_key(connection)
+        with self._agent_cache_lock:
+            entry = self._agent_cache.get(key)
+            if entry is not None:
+                self._agent_cache.move_to_end(key)
+                return entry[2]
+
+        from langchain_community.agent_toolkits.sql.base import create_sql_agent
+        from langchain_community.agent_toolkits.sql.toolkit import SQLDatabaseToolkit
+        from cached_sql_database import CachedSQLDatabase
+
+        # Tables are reflected when the agent first asks about them, not up front
+        db = CachedSQLDatabase.from_uri(
+            self.get_connection_uri(connection),
+            engine_args=SQL_ENGINE_ARGS,
+            lazy_table_reflection=True
+        )
+        toolkit = SQLDatabaseToolkit(db=db, llm=self.llm)
+        agent = create_sql_agent(
+            llm=self.llm,
+            toolkit=toolkit,
+            verbose=AGENT_VERBOSE,
+            agent_kwargs={
+                "handle_parsing_errors": True
+            },
+            # The SQL query, its results and the reasoning are read from the steps
+            agent_executor_kwargs={
+                "return_intermediate_steps": True
+            }
+        )
+
+        evicted = []
+        with self._agent_cache_lock:
+            if key in self._agent_cache:
+                # Another thread built this connection's agent first; keep theirs
+                evicted.append(db)
+                entry = self._agent_cache[key]
+            else:
+                entry = (db, toolkit, agent)
+                self._agent_cache[key] = entry
+                while len(self._agent_cache) > self.AGENT_CACHE_SIZE:
+                    evicted.append(self._agent_cache.popitem(last=False)[1][0])
+
+        for stale_db in evicted:
+            stale_db._engine.dispose()
+        return entry[2]
+
+    def refresh(self, connection: Optional[DatabaseConnection] = None) -> None:
+        """Drop cached agents and results (for one connection or all), e.g. after DDL changes"""
+        with self._agent_cache_lock:
+            if connection is None:
+                evicted = [entry[0] for entry in self._agent_cache.values()]
+                self._agent_cache.clear()
+            else:
+                entry = self._agent_cache.pop(self._cache_key(connection), None)
+                evicted = [entry[0]] if entry is not None else []
 
-    def process_query(self, query: str, connection: DatabaseConnection) -> dict:
+        with self._result_cache_lock:
+            if connection is None:
+                self._result_cache.clear()
+            else:
+                connection_key = self._cache_key(connection)
+                for result_key in [k for k in self._result_cache if k[0] == connection_key]:
+                    del self._result_cache[result_key]
+
+        for db in evicted:
+            db._engine.dispose()
+
+    def _result_key(self, query: str, connection: DatabaseConnection, include_reasoning: bool) -> Tuple[str, str, bool]:
+        """Key a query by connection, whitespace/case-normalized text and response shape"""
+        return self._cache_key(connection), " ".join(query.lower().split()), include_reasoning
+
+    def _get_cached_result(self, key: Tuple[str, str, bool]) -> Optional[dict]:
+        """Return a stored result that has not expired"""
+        with self._result_cache_lock:
+            entry = self._result_cache.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] >= self.RESULT_CACHE_TTL:
+                del self._result_cache[key]
+                return None
+            self._result_cache.move_to_end(key)
+            return entry[1]
+
+    def _store_result(self, key: Tuple[str, str, bool], result: dict) -> None:
+        """Remember a successful result"""
+        if result.get("status") != "success":
+            return
+        with self._result_cache_lock:
+            self._result_cache[key] = (time.monotonic(), result)
+            self._result_cache.move_to_end(key)
+            while len(self._result_cache) > self.RESULT_CACHE_SIZE:
+                self._result_cache.popitem(last=False)
+
+    def _format_result(self, agent_result: dict, include_reasoning: bool) -> dict:
+        """
+        Extract the SQL query and results from an agent result and build the response.
+        Reasoning is only included on request, as {"tool", "input"} per step.
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Agent result: %s", agent_result)
+
+        # Extract the SQL query and results
+        sql_query = None
+        sql_results = None
+        reasoning = []
+        intermediate_steps = agent_result.get("intermediate_steps", [])
+        
+        for step in intermediate_steps:
+            if isinstance(step, tuple) and len(step) >= 2:
+                action, response = step
+                tool = getattr(action, 'tool', None)
+                if include_reasoning:
+                    reasoning.append({"tool": tool, "input": getattr(action, 'tool_input', None)})
+                if tool == "sql_db_query":
+                    sql_query = action.tool_input
+                    sql_results = response
+
+        logger.debug("Extracted SQL query: %s", sql_query)
+
+        llm_analysis = {"final_answer": agent_result.get("output", "")}
+        if include_reasoning:
+            llm_analysis = {"reasoning": reasoning, **llm_analysis}
+
+        # Format the response
+        return {
+            "status": "success",
+            "llm_analysis": llm_analysis,
+            "sql_data": {
+                "query": sql_query,
+                "results": sql_results
+            }
+        }
+
+    def _format_error(self, error: Exception) -> dict:
+        """Build the error response for a failed query"""
+        logger.error("Error processing query: %s", str(error))
+        return {
+            "status": "error",
+            "message": str(error)
+        }
+
+    def process_query(
+        self,
+        query: str,
+        connection: DatabaseConnection,
+        fresh: bool = False,
+        include_reasoning: bool = False
+    ) -> dict:
         """Process a natural language query and return the result"""
         try:
-            print("\n=== Processing Query ===")
-            print(f"Input Query: {query}")
-
-            # Set up database connection
-            connection_uri = self.get_connection_uri(connection)
-            db = SQLDatabase.from_uri(connection_uri)
-            
-            # Initialize toolkit and agent for this query
-            toolkit = SQLDatabaseToolkit(db=db, llm=self.llm)
-            agent = create_sql_agent(
-                llm=self.llm,
-                toolkit=toolkit,
-                verbose=True,
-                agent_kwargs={
-                    "handle_parsing_errors": True
-                }
-            )
+            logger.info("Processing query: %s", query)
+
+            result_key = self._result_key(query, connection, include_reasoning)
+            if not fresh:
+                cached = self._get_cached_result(result_key)
+                if cached is not None:
+                    return cached
+
+            # Reuse the database connection and agent for this connection
+            agent = self.get_agent(connection)
 
             # Execute the query through the agent
             agent_result = agent.invoke({
                 "input": query,
-                "chat_history": self.memory.chat_memory.messages if self.memory else []
+                "chat_history": self.memory.dialogue()
             })
+            result = self._format_result(agent_result, include_reasoning)
+            self._store_result(result_key, result)
+            return result
 
-            print("\n=== Agent Result ===")
-            print(json.dumps(agent_result, indent=2, default=str))
-
-            # Extract the SQL query and results
-            sql_query = None
-            sql_results = None
-            intermediate_steps = agent_result.get("intermediate_steps", [])
-            
-            for step in intermediate_steps:
-                if isinstance(step, tuple) and len(step) >= 2:
-                    action, response = step
-                    if hasattr(action, 'tool') and action.tool == "sql_db_query":
-                        sql_query = action.tool_input
-                        sql_results = response
-
-            print("\n=== Extracted SQL Information ===")
-            print(f"SQL Query: {sql_query}")
-            print(f"SQL Results: {sql_results}")
-
-            # Format the response
-            response = {
-                "status": "success",
-                "llm_analysis": {
-                    "reasoning": intermediate_steps,
-                    "final_answer": agent_result.get("output", "")
-                },
-                "sql_data": {
-                    "query": sql_query,
-                    "results": sql_results
-                }
-            }
+        except Exception as e:
+            return self._format_error(e)
+
+    async def aprocess_query(
+        self,
+        query: str,
+        connection: DatabaseConnection,
+        fresh: bool = False,
+        include_reasoning: bool = False
+    ) -> dict:
+        """Async variant of process_query that does not block the event loop"""
+        try:
+            logger.info("Processing query: %s", query)
+
+            result_key = self._result_key(query, connection, include_reasoning)
+            if not fresh:
+                cached = self._get_cached_result(result_key)
+                if cached is not None:
+                    return cached
 
-            print("\n=== Final Formatted Response ===")
-            print(json.dumps(response, indent=2, default=str))
+            # Schema reflection on a cache miss is blocking, so build the agent in a worker thread
+            agent = await asyncio.to_thread(self.get_agent, connection)
 
-            return response
+            agent_result = await agent.ainvoke({
+                "input": query,
+                "chat_history": self.memory.dialogue()
+            })
+            result = self._format_result(agent_result, include_reasoning)
+            self._store_result(result_key, result)
+            return result
 
         except Exception as e:
-            print(f"\n=== Error Processing Query ===")
-            print(f"Error: {str(e)}")
-            return {
-                "status": "error",
-                "message": str(e)
-            }
+            return self._format_error(e)
+
+    async def aprocess_queries(
+        self,
+        queries: List[str],
+        connection: DatabaseConnection,
+        fresh: bool = False,
+        include_reasoning: bool = False
+    ) -> List[dict]:
+        """Process several queries against one connection concurrently"""
+        return await asyncio.gather(*(
+            self.aprocess_query(query, connection, fresh, include_reasoning) for query in queries
+        ))
 
 def main():
     """Main function for testing"""
@@ -1,232 +1,328 @@
-from langchain_community.agent_toolkits.sql.base import create_sql_agent
 from langchain_community.agent_toolkits.sql.toolkit import SQLDatabaseToolkit
-from langchain_community.utilities import SQLDatabase
-from langchain_openai import ChatOpenAI
-from langchain_community.tools import (
-    InfoSQLDatabaseTool,
-    ListSQLDatabaseTool,
-    QuerySQLCheckerTool,
-    QuerySQLDatabaseTool
-)
-from langchain.prompts import PromptTemplate
-from langchain.chains import create_sql_query_chain
-from langchain.memory import ConversationBufferMemory
+from langchain_core.agents import AgentAction
+from langchain_core.callbacks import BaseCallbackHandler
 from dotenv import load_dotenv
-import pandas as pd
+from functools import cached_property
+from chat_memory import BoundedChatMemory
+from langchain_agent import AGENT_VERBOSE, SQL_ENGINE_ARGS, get_llm
+import logging
 import os
 from tools.query_sql_viz_tool import QuerySQLDatabaseForVizTool
-from langchain_community.agent_toolkits.sql.toolkit import SQLDatabaseToolkit
-from langchain_core.tools import BaseTool
-from typing import List, Dict, Any, Union, Optional
+from typing import TYPE_CHECKING, List, Dict, Optional, Tuple
 import re
-import json
+
+# pandas and the agent factory are imported on first use
+if TYPE_CHECKING:
+    import pandas as pd
+    from langchain_core.tools import BaseTool
 
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Answer questions matching EnhancedDatabaseManager._SQL_TEMPLATES without the agent (SQL_TEMPLATES=1)
+USE_SQL_TEMPLATES = os.getenv("SQL_TEMPLATES") == "1"
+
 class VisualizationSQLDatabaseToolkit(SQLDatabaseToolkit):
     """Extended SQL Database toolkit that includes visualization-specific tools."""
+
+    @cached_property
+    def viz_tool(self) -> QuerySQLDatabaseForVizTool:
+        """The visualization query tool, built once since the toolkit's database is fixed"""
+        return QuerySQLDatabaseForVizTool(db=self.db)
     
-    def get_tools(self) -> List[BaseTool]:
+    def get_tools(self) -> List["BaseTool"]:
         """Get the tools in the toolkit."""
         tools = super().get_tools()
-        viz_tool = QuerySQLDatabaseForVizTool(db=self.db)
-        tools.append(viz_tool)
+        tools.append(self.viz_tool)
         return tools
 
+class _SQLQueryCaptured(Exception):
+    """Raised to end an agent run once its SQL query has executed"""
+
+    def __init__(self, sql_query: str):
+        super().__init__(sql_query)
+        self.sql_query = sql_query
+
+class _StopAfterSQLQuery(BaseCallbackHandler):
+    """Callback that stops the agent after its first successful sql_db_query call"""
+
+    # Let _SQLQueryCaptured propagate out of the agent instead of being logged
+    raise_error = True
+
+    def __init__(self):
+        self._sql_inputs = {}
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        if (serialized or {}).get("name") == "sql_db_query":
+            self._sql_inputs[run_id] = input_str
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        sql_query = self._sql_inputs.pop(run_id, None)
+        # The query tool reports failures as an "Error: ..." observation
+        if sql_query is not None and not str(output).startswith("Error"):
+            raise _SQLQueryCaptured(sql_query)
+
 class EnhancedDatabaseManager:
+    # Query phrases that signal each visualization type, matched anywhere in the
+    # lower-cased query (so 'trend' also matches 'uptrend' and 'trendline')
+    _TIME_KEYWORDS = re.compile('trend|over time|monthly|daily')
+    _COMPARISON_KEYWORDS = re.compile('compare|comparison|versus')
+    _DISTRIBUTION_KEYWORDS = re.compile('distribution|proportion|share')
+
+    # Recurring questions answered with canned SQL instead of the agent, as
+    # (dialect, question pattern, SQL). Named groups become bound parameters, never
+    # string formatting. Opt-in via SQL_TEMPLATES=1, since the SQL assumes a
+    # sales(date, product, amount) table; a hit has no natural-language answer.
+    _SQL_TEMPLATES = [
+        (
+            "postgresql",
+            re.compile(r"\bmonthly sales trend for (?P<product>.+?) in (?P<year>\d{4})\b", re.IGNORECASE),
+            "SELECT date_trunc('month', date)::date AS date, SUM(amount) AS total_sales "
+            "FROM sales WHERE product = :product AND EXTRACT(YEAR FROM date) = CAST(:year AS INTEGER) "
+            "GROUP BY 1 ORDER BY 1"
+        ),
+        (
+            "postgresql",
+            re.compile(r"\btotal sales by product (?:for|in) (?P<year>\d{4})\b", re.IGNORECASE),
+            "SELECT product, SUM(amount) AS total_sales "
+            "FROM sales WHERE EXTRACT(YEAR FROM date) = CAST(:year AS INTEGER) "
+            "GROUP BY product ORDER BY product"
+        )
+    ]
+
     def __init__(self):
         """Initialize the database manager with all necessary tools and chains"""
+        from langchain_community.agent_toolkits.sql.base import create_sql_agent
+        from cached_sql_database import CachedSQLDatabase
+
         # Database connection
-        self.db = SQLDatabase.from_uri(
+        self.db = CachedSQLDatabase.from_uri(
             os.getenv("DATABASE_URL"),
             include_tables=['sales'],  # Specify your tables
-            sample_rows_in_table_info=3
+            sample_rows_in_table_info=3,
+            engine_args=SQL_ENGINE_ARGS,
+            lazy_table_reflection=True
         )
         
         # Initialize the language model
-        self.llm = ChatOpenAI(
-            temperature=0,
-            model_name="gpt-3.5-turbo",
-            openai_api_key=os.getenv("OPENAI_API_KEY")
-        )
+        self.llm = get_llm()
 
         # Initialize memory
-        self.memory = ConversationBufferMemory(
-            memory_key="chat_history",
-            return_messages=True
-        )
+        self.memory = BoundedChatMemory()
 
         # Create the agent executor with VisualizationSQLDatabaseToolkit instead
         self.agent_executor = create_sql_agent(
             llm=self.llm,
             toolkit=VisualizationSQLDatabaseToolkit(db=self.db, llm=self.llm),
-            verbose=True,
+            verbose=AGENT_VERBOSE,
             agent_kwargs={
                 "handle_parsing_errors": True
+            },
+            # The SQL query, its results and the reasoning are read from the steps
+            agent_executor_kwargs={
+                "return_intermediate_steps": True
             }
         )
 
-    def process_query(self, user_query: str) -> dict:
-        """Process a natural language query and return both LLM analysis and visualization data"""
+    def process_query(self, user_query: str, return_sql_only: bool = False, include_reasoning: bool = False) -> dict:
+        """
+        Process a natural language query and return both LLM analysis and visualization data.
+        With return_sql_only, the agent stops once its SQL query has run, skipping the
+        final natural-language answer; the response then has no llm_analysis.
+        With include_reasoning, llm_analysis lists each agent step as {"tool", "input"}.
+        Questions answered from an SQL template (see _SQL_TEMPLATES) skip the LLM, so
+        their response has no llm_analysis either.
+        """
         try:
+            # Recognized questions skip the LLM entirely; the agent runs if the template SQL fails
+            if USE_SQL_TEMPLATES:
+                template_match = self._match_sql_template(user_query)
+                if template_match is not None:
+                    response = self._run_sql_direct(user_query, *template_match)
+                    if response is not None:
+                        return response
+
             # Get LLM reasoning and SQL execution
-            agent_result = self.agent_executor.invoke({
-                "input": user_query,
-                "chat_history": self.memory.chat_memory.messages if self.memory else []
-            })
-            
-            # Enhanced debugging
-            print("\nFull Agent Result Structure:")
-            print("Keys available:", agent_result.keys())
-            print("Intermediate Steps:", agent_result.get("intermediate_steps", "Not found"))
-            
-            # Debug logging
-            print("\nDebug - Agent Result:", json.dumps(agent_result, indent=2, default=str))
-            
-            # Extract SQL query with better error handling
             sql_query = None
+            config = {"callbacks": [_StopAfterSQLQuery()]} if return_sql_only else None
             try:
-                sql_query = self._extract_sql_query(agent_result)
-                if not sql_query:
-                    raise ValueError("Extracted SQL query is empty")
-            except Exception as e:
-                print(f"SQL Extraction failed: {str(e)}")
-                # Try to extract from raw string
-                raw_text = str(agent_result)
-                matches = re.findall(r"SELECT.*?(?=\[|$)", raw_text, re.IGNORECASE | re.DOTALL)
-                if matches:
-                    sql_query = matches[-1].strip()
-                else:
-                    raise ValueError("Could not extract SQL query")
+                agent_result = self.agent_executor.invoke({
+                    "input": user_query,
+                    "chat_history": self.memory.dialogue()
+                }, config=config)
+            except _SQLQueryCaptured as captured:
+                agent_result = {}
+                sql_query = captured.sql_query
             
-            print("\nDebug - Extracted SQL Query:", sql_query)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Agent result: %s", agent_result)
             
-            # Extract LLM reasoning
-            llm_output = {
-                "reasoning": agent_result.get("intermediate_steps", []),
-                "final_answer": agent_result.get("output", "")
-            }
+            # Extract the SQL query the agent ran and, on request, its reasoning
+            scanned_query, reasoning = self._scan_steps(agent_result, include_reasoning)
+            if sql_query is None:
+                sql_query = scanned_query
+                if not sql_query:
+                    raise ValueError("No SQL query found in agent result")
             
-            # Get SQL results using the visualization tool
-            viz_tool = QuerySQLDatabaseForVizTool(db=self.db)
-            sql_result = viz_tool._run(self._extract_sql_query(agent_result))
+            logger.debug("Extracted SQL query: %s", sql_query)
             
-            # Parse and format the data for visualization
-            df = pd.DataFrame(sql_result["raw_data"])
-            chart_type = self._determine_visualization_type(user_query, df)
-            visualization_data = self._format_for_visualization(df, chart_type)
+            llm_output = {"final_answer": agent_result.get("output", "")}
+            if include_reasoning:
+                llm_output = {"reasoning": reasoning, **llm_output}
             
-            return {
-                "status": "success",
-                "llm_analysis": {
-                    "reasoning": llm_output["reasoning"],
-                    "final_answer": llm_output["final_answer"]
-                },
-                "sql_data": {
-                    "query": sql_result.get("sql_query", ""),
-                    "raw_data": sql_result["raw_data"],
-                    "columns": sql_result["column_names"]
-                },
-                "visualization": {
-                    "chart_data": visualization_data,
-                    "chart_type": chart_type
-                }
-            }
+            # Fetch the results straight into a DataFrame
+            import pandas as pd
+            df = pd.read_sql(sql_query, self.db._engine)
+            return self._build_response(user_query, sql_query, df, None if return_sql_only else llm_output)
 
         except Exception as e:
-            print(f"Error processing query: {str(e)}")
-            return {
-                "status": "error",
-                "message": str(e)
-            }
+            return self._format_error(e)
+
+    def _match_sql_template(self, user_query: str) -> Optional[Tuple[str, Dict[str, str]]]:
+        """Return (sql, params) for the first template for this database matching the question, if any"""
+        dialect = self.db.dialect
+        for template_dialect, pattern, sql in self._SQL_TEMPLATES:
+            if template_dialect != dialect:
+                continue
+            match = pattern.search(user_query)
+            if match:
+                return sql, match.groupdict()
+        return None
+
+    def _run_sql_direct(self, user_query: str, sql: str, params: Dict[str, str]) -> Optional[dict]:
+        """
+        Run template SQL with bound parameters and build the response (without
+        llm_analysis) without the agent. Returns None if the SQL fails.
+        """
+        import pandas as pd
+        from sqlalchemy import text
 
-    def _extract_sql_query(self, agent_result: Dict) -> str:
-        """Extract the SQL query from agent result"""
-        # Debug the structure
-        print("\nExtracting SQL from structure:")
-        for key, value in agent_result.items():
-            print(f"Key: {key}")
-            print(f"Type: {type(value)}")
+        try:
+            logger.debug("Answering from SQL template: %s %s", sql, params)
+            df = pd.read_sql(text(sql), self.db._engine, params=params)
+            return self._build_response(user_query, sql, df, None)
+        except Exception as e:
+            logger.warning("SQL template failed, falling back to the agent: %s", str(e))
+            return None
+
+    def _build_response(
+        self,
+        user_query: str,
+        sql_query: str,
+        df: "pd.DataFrame",
+        llm_output: Optional[dict]
+    ) -> dict:
+        """Build the response for a query's results; llm_analysis is omitted when llm_output is None"""
+        raw_data = df.to_dict(orient="records")
+        
+        # Format the data for visualization
+        chart_type = self._determine_visualization_type(user_query, df)
+        visualization_data = self._format_for_visualization(df, chart_type)
         
-        # Look in intermediate steps
-        steps = agent_result.get("intermediate_steps", [])
-        for step in steps:
+        response = {
+            "status": "success",
+            "sql_data": {
+                "query": sql_query,
+                "raw_data": raw_data,
+                "columns": df.columns.tolist()
+            },
+            "visualization": {
+                "chart_data": visualization_data,
+                "chart_type": chart_type
+            }
+        }
+        if llm_output is not None:
+            response["llm_analysis"] = llm_output
+        return response
+
+    def _format_error(self, error: Exception) -> dict:
+        """Build the error response for a failed query"""
+        logger.error("Error processing query: %s", str(error))
+        return {
+            "status": "error",
+            "message": str(error)
+        }
+
+    def _scan_steps(self, agent_result: Dict, include_reasoning: bool) -> Tuple[Optional[str], List[dict]]:
+        """
+        Walk the agent's steps once, returning the last SQL query it passed to
+        sql_db_query and (with include_reasoning) each step as {"tool", "input"}.
+        Observations are never copied, so large result sets aren't carried along.
+        """
+        sql_query = None
+        reasoning = []
+        for step in agent_result.get("intermediate_steps", []):
             if isinstance(step, tuple) and len(step) >= 2:
-                action, action_input = step
-                if hasattr(action, 'tool') and action.tool == "sql_db_query":
-                    # Extract query before the results
-                    query = action_input.split('[')[0].strip()
-                    if query.upper().startswith("SELECT"):
-                        return query
-
-        # Look in the action input directly
-        if "action_input" in str(agent_result).lower():
-            matches = re.findall(r"Action Input: (SELECT.*?)(?:\[|\n|$)", 
-                               str(agent_result), re.IGNORECASE | re.DOTALL)
-            if matches:
-                return matches[-1].strip()
-
-        raise ValueError("No SQL query found in agent result")
-
-    def _determine_visualization_type(self, query: str, df: pd.DataFrame) -> str:
+                action = step[0]
+                if include_reasoning:
+                    reasoning.append({"tool": getattr(action, 'tool', None), "input": getattr(action, 'tool_input', None)})
+                if isinstance(action, AgentAction) and action.tool == "sql_db_query":
+                    tool_input = action.tool_input
+                    if isinstance(tool_input, dict):
+                        tool_input = tool_input.get("query", "")
+                    sql_query = str(tool_input).strip() or sql_query
+        return sql_query, reasoning
+
+    def _determine_visualization_type(self, query: str, df: "pd.DataFrame") -> str:
         """Determine the most appropriate visualization type"""
         query = query.lower()
-        columns = df.columns.tolist()
-
-        # Define visualization rules
-        rules = [
-            # Time series rules
-            (lambda q, cols: 'date' in cols and any(x in q for x in ['trend', 'over time', 'monthly', 'daily']), 'line'),
-            # Comparison rules
-            (lambda q, cols: 'product' in cols and any(x in q for x in ['compare', 'comparison', 'versus']), 'bar'),
-            # Distribution rules
-            (lambda q, cols: 'total_sales' in cols and any(x in q for x in ['distribution', 'proportion', 'share']), 'pie'),
-            # Default rules
-            (lambda q, cols: 'product' in cols, 'bar'),
-            (lambda q, cols: 'date' in cols, 'line')
-        ]
+        columns = set(df.columns)
 
         # Apply rules in order
-        for rule, chart_type in rules:
-            if rule(query, columns):
-                return chart_type
+        # Time series rules
+        if 'date' in columns and self._TIME_KEYWORDS.search(query):
+            return 'line'
+        # Comparison rules
+        if 'product' in columns and self._COMPARISON_KEYWORDS.search(query):
+            return 'bar'
+        # Distribution rules
+        if 'total_sales' in columns and self._DISTRIBUTION_KEYWORDS.search(query):
+            return 'pie'
+        # Default rules
+        if 'product' in columns:
+            return 'bar'
+        if 'date' in columns:
+            return 'line'
 
         return 'bar'  # Default fallback
 
-    def _format_for_visualization(self, df: pd.DataFrame, chart_type: str) -> dict:
+    def _format_for_visualization(self, df: "pd.DataFrame", chart_type: str) -> dict:
         """Format the DataFrame for visualization"""
-        if df.empty:
+        import pandas as pd
+
+        if df.empty or chart_type not in ('line', 'bar', 'pie'):
             return {}
 
-        # Ensure proper date formatting
+        # Ensure proper date formatting; sort only when the rows are out of order
         if 'date' in df.columns:
-            df['date'] = pd.to_datetime(df['date'])
-            df = df.sort_values('date')
+            dates = pd.to_datetime(df['date'])
+            if dates.dt.tz is not None:
+                dates = dates.dt.tz_localize(None)
+            df = df.assign(date=dates)
+            if not dates.is_monotonic_increasing:
+                df = df.sort_values('date', kind='stable')
 
-        # Format based on chart type
-        formatters = {
-            'line': lambda df: {
-                "dates": df['date'].dt.strftime('%Y-%m-%d').tolist(),
-                "sales": df['total_sales'].tolist(),
-                "chart_type": "line"
-            },
-            'bar': lambda df: {
-                "categories": df['product'].tolist() if 'product' in df.columns else df.index.tolist(),
-                "sales": df['total_sales'].tolist(),
-                "chart_type": "bar"
-            },
-            'pie': lambda df: {
-                "categories": df['product'].tolist() if 'product' in df.columns else df.index.tolist(),
+        # Format based on chart type; day-precision datetime64 -> str avoids per-row strftime
+        if chart_type == 'line':
+            return {
+                "dates": df['date'].to_numpy(dtype='datetime64[D]').astype(str).tolist(),
                 "sales": df['total_sales'].tolist(),
-                "chart_type": "pie"
+                "chart_type": chart_type
             }
-        }
 
-        return formatters.get(chart_type, lambda df: {})(df)
+        categories = df['product'] if 'product' in df.columns else df.index
+        return {
+            "categories": categories.tolist(),
+            "sales": df['total_sales'].tolist(),
+            "chart_type": chart_type
+        }
 
 # Example usage
 if __name__ == "__main__":
+    import pandas as pd
+
     db_manager = EnhancedDatabaseManager()
     
     # Test queries
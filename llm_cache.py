@@ -0,0 +1,44 @@
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+import hashlib
+import json
+import time
+
+class LLMCache:
+    """
+    In-process LRU cache for LLM responses with per-entry expiry.
+    Methods are async so a shared backend (e.g. Redis) can replace it without
+    touching callers.
+    """
+
+    def __init__(self, max_size: int = 1024, default_ttl: float = 604800):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+
+    @staticmethod
+    def make_key(**parts: Any) -> str:
+        """Hash the call's identifying parts (function, model, inputs) into a cache key"""
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    async def get(self, key: str) -> Optional[Any]:
+        """Return the cached value, or None if it is missing or expired"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() >= entry[0]:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """Store a value for ttl seconds (default_ttl if not given)"""
+        expires_at = time.monotonic() + (self.default_ttl if ttl is None else ttl)
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def clear(self) -> None:
+        self._entries.clear()
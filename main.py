@@ -1,12 +1,20 @@
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from langchain_agent import LangChainAgent
+from llm_cache import LLMCache
+import asyncio
 import logging
 import json
-from openai import OpenAI
-from database_connection import DatabaseConnection, test_connection
-from typing import Dict, Optional
+import os
+import re
+import httpx
+import ijson
+from openai import AsyncOpenAI
+from database_connection import DatabaseConnection, close_postgresql_pools, test_connection, test_connections
+from typing import Dict, List, Optional, Tuple
+import uvicorn
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -27,40 +35,112 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize OpenAI client
-client = OpenAI()
+# Initialize OpenAI client over a shared HTTP/2 connection pool; fail fast
+# instead of the SDK's 10 minute default timeout
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    timeout=30
+)
+client = AsyncOpenAI(http_client=http_client, max_retries=2, timeout=30)
+
+# Model for chart suggestion and parsing
+CHART_MODEL = "gpt-4o-mini"
+
+# Chart types the frontend can render
+CHART_TYPES = ("bar", "line", "area", "pie", "donut", "card")
+
+# Chart suggestions and chart JSON for answers seen before
+llm_cache = LLMCache()
 
 class Query(BaseModel):
     query: str
     connection: DatabaseConnection
     chart_type: Optional[str] = None
     color_palette: Optional[str] = "warm"
+    # Skip the agent's result cache, e.g. after the underlying data changed
+    fresh: bool = False
 
 # Initialize LangChain agent
 agent = LangChainAgent()
 
-def suggest_chart_type(api_text: str) -> str:
-    """Suggest the best chart type based on the data"""
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Close pooled database and HTTP connections"""
+    await close_postgresql_pools()
+    await http_client.aclose()
+    # Dispose the SQLAlchemy engine pools behind the cached agents
+    agent.refresh()
+
+# Literal patterns in the SQL tool's result text, replaced to get the shape of the rows
+_RESULT_LITERALS = [
+    (re.compile(r"datetime\.(?:date|datetime)\([^)]*\)"), "D"),
+    (re.compile(r"Decimal\('[^']*'\)"), "N"),
+    (re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\""), "S"),
+    (re.compile(r"-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?"), "N")
+]
+_RESULT_ROW = re.compile(r"\([^()]*\)")
+
+def _result_shape(sql_results) -> Optional[str]:
+    """
+    Fingerprint SQL results by row count and column kinds, e.g. "12:(D, N)",
+    so differently filtered runs of the same query share a chart suggestion
+    """
+    if not sql_results:
+        return None
+    shape = str(sql_results)
+    # The SQL tool reports failures as an "Error: ..." observation, which has no shape
+    if shape.lstrip().startswith("Error"):
+        return None
+    for pattern, replacement in _RESULT_LITERALS:
+        shape = pattern.sub(replacement, shape)
+    rows = _RESULT_ROW.findall(shape)
+    if not rows:
+        return None
+    return f"{len(rows)}:{rows[0]}"
+
+def _suggestion_cache_key(api_text: str, sql_results=None) -> str:
+    """Key a chart type suggestion by the shape of sql_results when given, otherwise by the text"""
+    shape = _result_shape(sql_results)
+    if shape is not None:
+        return LLMCache.make_key(fn="suggest_chart_type", model=CHART_MODEL, shape=shape)
+    return LLMCache.make_key(fn="suggest_chart_type", model=CHART_MODEL, text=api_text)
+
+async def suggest_chart_type(api_text: str, sql_results=None) -> str:
+    """
+    Suggest the best chart type based on the data.
+    Suggestions are cached by the shape of sql_results when given, otherwise by the text.
+    """
     prompt = f"""
     Based on the following data, suggest the best chart type (bar, line, area, pie, donut, card):
     {api_text}
     
     Return only the chart type name in lowercase.
     """
+    cache_key = _suggestion_cache_key(api_text, sql_results)
+    cached = await llm_cache.get(cache_key)
+    if cached is not None:
+        return cached
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
+        response = await client.chat.completions.create(
+            model=CHART_MODEL,
             messages=[{"role": "user", "content": prompt}],
-            temperature=0.2
+            temperature=0.2,
+            max_tokens=3
         )
-        return response.choices[0].message.content.strip().lower()
+        suggested_chart = response.choices[0].message.content.strip().strip(".").lower()
+        if suggested_chart not in CHART_TYPES:
+            logger.warning("Unexpected chart type suggested: %s", suggested_chart)
+            return "card"
+        await llm_cache.set(cache_key, suggested_chart)
+        return suggested_chart
     except Exception as e:
-        logger.error(f"Error suggesting chart type: {str(e)}")
+        logger.error("Error suggesting chart type: %s", e)
         return "card"  # Fallback to card display
 
-def parse_text_to_json(final_answer: str, chart_type: str):
-    """Parse text response into ECharts-compatible JSON format"""
-    prompt = f"""
+def _chart_json_prompt(final_answer: str, chart_type: str) -> str:
+    """Build the prompt asking for ECharts JSON of the given chart type"""
+    return f"""
     Parse the following text into a JSON format suitable for ECharts {chart_type} chart.
     Extract numerical values and their corresponding labels.
     Use this schema:
@@ -88,42 +168,48 @@ def parse_text_to_json(final_answer: str, chart_type: str):
     
     Text: {final_answer}
     """
+
+def _card_chart(final_answer: str) -> Dict:
+    """Card display needs no parsing: it is just the answer text"""
+    return {"type": "card", "content": final_answer}
+
+def _chart_json_cache_key(final_answer: str, chart_type: str) -> str:
+    return LLMCache.make_key(fn="parse_text_to_json", model=CHART_MODEL, chart_type=chart_type, text=final_answer)
+
+async def parse_text_to_json(final_answer: str, chart_type: str):
+    """Parse text response into ECharts-compatible JSON format"""
+    if chart_type == "card":
+        return _card_chart(final_answer)
+    prompt = _chart_json_prompt(final_answer, chart_type)
+    cache_key = _chart_json_cache_key(final_answer, chart_type)
+    cached = await llm_cache.get(cache_key)
+    if cached is not None:
+        return cached
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
+        # JSON mode guarantees the reply parses
+        response = await client.chat.completions.create(
+            model=CHART_MODEL,
             messages=[{"role": "user", "content": prompt}],
-            temperature=0.1
+            temperature=0.1,
+            response_format={"type": "json_object"}
         )
-        json_output = response.choices[0].message.content
-        
-        # Validate JSON
-        parsed = json.loads(json_output)
+        parsed = json.loads(response.choices[0].message.content)
+        await llm_cache.set(cache_key, parsed)
         return parsed
-    except json.JSONDecodeError:
-        logger.error("Invalid JSON generated by LLM")
-        return {"error": "Failed to generate valid chart data"}
     except Exception as e:
-        logger.error(f"Error parsing text to JSON: {str(e)}")
+        logger.error("Error parsing text to JSON: %s", e)
         return {"error": str(e)}
 
 @app.post("/query")
 async def handle_query(query: Query):
     try:
-        logger.info(f"Processing query: {query.query}")
+        logger.info("Processing query: %s", query.query)
         
-        # First test the database connection
+        # No separate connection test: the agent's own query fails if the database is unreachable
         try:
-            connection_result = await test_connection(query.connection)
-            if connection_result["status"] != "success":
-                raise HTTPException(status_code=400, detail="Database connection failed")
-        except Exception as conn_error:
-            logger.error(f"Database connection error: {str(conn_error)}")
-            raise HTTPException(status_code=400, detail=str(conn_error))
-        
-        try:
-            result = agent.process_query(query.query, query.connection)
+            result = await agent.aprocess_query(query.query, query.connection, fresh=query.fresh)
         except Exception as agent_error:
-            logger.error(f"Error in agent processing: {str(agent_error)}")
+            logger.error("Error in agent processing: %s", agent_error)
             return {
                 "status": "error",
                 "message": "Failed to process query",
@@ -133,14 +219,21 @@ async def handle_query(query: Query):
         if not result or not isinstance(result, dict):
             raise HTTPException(status_code=500, detail="Invalid response from agent")
             
-        logger.info(f"Query processed. Status: {result.get('status')}")
+        logger.info("Query processed. Status: %s", result.get("status"))
         
-        final_answer = result.get("llm_analysis", {}).get("final_answer")
-        suggested_chart = suggest_chart_type(final_answer)
+        if result.get("status") != "success":
+            raise HTTPException(status_code=400, detail=result.get("message", "Failed to process query"))
         
-        # Use suggested chart if none was specified
-        chart_type = query.chart_type or suggested_chart
-        chart_data = parse_text_to_json(final_answer, chart_type)
+        final_answer = result.get("llm_analysis", {}).get("final_answer")
+        if query.chart_type:
+            # The chart type is known, so there is nothing to suggest
+            suggested_chart = query.chart_type
+            chart_data = await parse_text_to_json(final_answer, query.chart_type)
+        else:
+            # Use suggested chart if none was specified; one call picks and builds it
+            suggested_chart, chart_data = await suggest_and_parse_chart(
+                final_answer, result.get("sql_data", {}).get("results")
+            )
         
         response = {
             "status": "success",
@@ -155,39 +248,243 @@ async def handle_query(query: Query):
         
         return response
         
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Exception in handle_query: {str(e)}")
+        logger.error("Exception in handle_query: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
+async def suggest_and_parse_chart(final_answer: str, sql_results=None) -> Tuple[str, Dict]:
+    """
+    Suggest a chart type and build its ECharts JSON in a single LLM call.
+    If results of the same shape were charted before, the suggested type is
+    reused and only the JSON is generated.
+    """
+    prompt = f"""
+    Suggest the best chart type (bar, line, area, pie, donut, card) for the following text
+    and parse it into ECharts JSON for that chart type.
+    Extract numerical values and their corresponding labels.
+    Return a JSON object of the form:
+    {{
+      "chart_type": "bar",
+      "chart_data": {{
+        "xAxis": {{ "type": "category", "data": [] }},
+        "yAxis": {{ "type": "value" }},
+        "series": [{{ "data": [], "type": "bar" }}]
+      }}
+    }}
+    
+    For pie/donut charts, chart_data uses:
+    {{
+      "series": [
+        {{
+          "type": "pie",
+          "data": [{{"value": 0, "name": "label"}}]
+        }}
+      ]
+    }}
+    
+    For card display, return an empty chart_data: {{}}
+    
+    Text: {final_answer}
+    """
+    cache_key = LLMCache.make_key(fn="suggest_and_parse_chart", model=CHART_MODEL, text=final_answer)
+    cached = await llm_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    suggestion_key = _suggestion_cache_key(final_answer, sql_results)
+    chart_type = await llm_cache.get(suggestion_key)
+    if chart_type is not None:
+        return chart_type, await parse_text_to_json(final_answer, chart_type)
+    try:
+        response = await client.chat.completions.create(
+            model=CHART_MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.1,
+            response_format={"type": "json_object"}
+        )
+        parsed = json.loads(response.choices[0].message.content)
+        chart_type = str(parsed.get("chart_type", "card")).strip().lower()
+        chart_data = parsed.get("chart_data")
+        if chart_type == "card":
+            # Card content is the answer itself, so it isn't taken from the model
+            result = ("card", _card_chart(final_answer))
+        elif chart_type in CHART_TYPES and isinstance(chart_data, dict) and chart_data:
+            result = (chart_type, chart_data)
+        else:
+            # Don't pair a fallback type with data built for another one, or cache it
+            logger.warning("Unusable chart suggested: %s", chart_type)
+            return "card", _card_chart(final_answer)
+        await llm_cache.set(cache_key, result)
+        await llm_cache.set(suggestion_key, chart_type)
+        return result
+    except Exception as e:
+        logger.error("Error suggesting and parsing chart: %s", e)
+        return "card", _card_chart(final_answer)
+
+def _sse_event(data: Dict) -> str:
+    """Format one server-sent event"""
+    return f"data: {json.dumps(data)}\n\n"
+
+async def _query_event_stream(query: Query):
+    """
+    Yield SSE events for each stage of a query: answer, suggested chart,
+    chart JSON tokens with each series as it completes, and the final chart data
+    """
+    try:
+        result = await agent.aprocess_query(query.query, query.connection, fresh=query.fresh)
+        if result.get("status") != "success":
+            yield _sse_event({"stage": "error", "message": result.get("message", "Failed to process query")})
+            return
+
+        final_answer = result.get("llm_analysis", {}).get("final_answer")
+        yield _sse_event({
+            "stage": "answer",
+            "answer": final_answer,
+            "sql_query": result.get("sql_data", {}).get("query"),
+            "sql_results": result.get("sql_data", {}).get("results")
+        })
+
+        if query.chart_type:
+            chart_type = query.chart_type
+        else:
+            chart_type = await suggest_chart_type(final_answer, result.get("sql_data", {}).get("results"))
+        yield _sse_event({"stage": "suggested_chart", "suggested_chart": chart_type})
+
+        cache_key = _chart_json_cache_key(final_answer, chart_type)
+        chart_data = _card_chart(final_answer) if chart_type == "card" else await llm_cache.get(cache_key)
+        if chart_data is None:
+            # Forward the chart JSON as it is generated, then send the parsed result
+            stream = await client.chat.completions.create(
+                model=CHART_MODEL,
+                messages=[{"role": "user", "content": _chart_json_prompt(final_answer, chart_type)}],
+                temperature=0.1,
+                response_format={"type": "json_object"},
+                stream=True
+            )
+            tokens = []
+            # Parse the JSON as it arrives so each finished series can be drawn early
+            series = ijson.sendable_list()
+            series_parser = ijson.items_coro(series, "series.item", use_float=True)
+            # Close the completion even if the client disconnects mid-stream
+            async with stream:
+                async for chunk in stream:
+                    token = chunk.choices[0].delta.content if chunk.choices else None
+                    if token:
+                        tokens.append(token)
+                        yield _sse_event({"stage": "chart_token", "token": token})
+                        if series_parser is not None:
+                            try:
+                                series_parser.send(token.encode())
+                            except ijson.JSONError:
+                                series_parser = None
+                            for partial_series in series:
+                                yield _sse_event({"stage": "partial_chart", "partial_chart": {"series": [partial_series]}})
+                            del series[:]
+            if series_parser is not None:
+                try:
+                    series_parser.close()
+                except ijson.JSONError:
+                    pass
+            try:
+                chart_data = json.loads("".join(tokens))
+                await llm_cache.set(cache_key, chart_data)
+            except json.JSONDecodeError:
+                logger.error("Invalid JSON generated by LLM")
+                chart_data = {"error": "Failed to generate valid chart data"}
+
+        yield _sse_event({"stage": "chart_data", "chart_data": chart_data})
+
+    except Exception as e:
+        logger.error("Exception in query stream: %s", e)
+        yield _sse_event({"stage": "error", "message": str(e)})
+
+@app.post("/query/stream")
+async def handle_query_stream(query: Query):
+    """Stream each stage of /query as server-sent events as soon as it completes"""
+    return StreamingResponse(
+        _query_event_stream(query),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Questions the /test endpoint runs against the DATABASE_URL database
+TEST_QUERIES = (
+    "Show me total sales by product for 2023",
+    "Display the monthly sales trend for Product A in 2023",
+    "What is the market share distribution among our competitors?"
+)
+
+# Ports assumed when DATABASE_URL doesn't give one
+_DEFAULT_PORTS = {"postgresql": 5432, "mysql": 3306}
+
+def _test_probe_connection() -> Optional[DatabaseConnection]:
+    """Build the connection for the /test probes from DATABASE_URL, if it is set"""
+    database_url = os.getenv("DATABASE_URL")
+    if not database_url:
+        return None
+    from sqlalchemy.engine import make_url
+
+    url = make_url(database_url)
+    db_type = url.get_backend_name()
+    return DatabaseConnection(
+        type=db_type,
+        host=url.host or "localhost",
+        port=url.port or _DEFAULT_PORTS.get(db_type, 0),
+        database_name=url.database or "",
+        username=url.username or "",
+        password=url.password or ""
+    )
+
+async def _run_test_probe(query: str, connection: DatabaseConnection) -> Dict:
+    """Run one /test query through the agent and both chart helpers"""
+    result = await agent.aprocess_query(query, connection)
+    final_answer = result.get("llm_analysis", {}).get("final_answer")
+    suggested_chart, chart_data = await suggest_and_parse_chart(final_answer, result.get("sql_data", {}).get("results"))
+    
+    return {
+        "query": query,
+        "status": result.get("status"),
+        "answer": final_answer,
+        "has_sql": bool(result.get("sql_data", {}).get("query")),
+        "has_results": bool(result.get("sql_data", {}).get("results")),
+        "suggested_chart": suggested_chart,
+        "chart_data": chart_data,
+        "error": None
+    }
+
 @app.get("/test")
-async def test_endpoint():
-    """Test endpoint to verify API functionality"""
-    test_queries = [
-        "Show me total sales by product for 2023",
-        "Display the monthly sales trend for Product A in 2023",
-        "What is the market share distribution among our competitors?"
-    ]
+async def test_endpoint(fresh: bool = False):
+    """
+    Test endpoint to verify API functionality.
+    A fully successful run is reused for 7 days; pass fresh=true to re-run the probes.
+    """
+    connection = _test_probe_connection()
+    if connection is None:
+        raise HTTPException(status_code=400, detail="DATABASE_URL is not configured")
+
+    # A different model, probe list or database makes earlier runs stale
+    cache_key = LLMCache.make_key(
+        fn="test_endpoint",
+        model=CHART_MODEL,
+        queries=list(TEST_QUERIES),
+        connection=connection.model_dump()
+    )
+    if not fresh:
+        cached = await llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
+    
+    # The probes are independent, so run them concurrently
+    probe_results = await asyncio.gather(
+        *(_run_test_probe(query, connection) for query in TEST_QUERIES),
+        return_exceptions=True
+    )
     
     results = []
-    for query in test_queries:
-        try:
-            result = agent.process_query(query)
-            final_answer = result.get("llm_analysis", {}).get("final_answer")
-            suggested_chart = suggest_chart_type(final_answer)
-            chart_data = parse_text_to_json(final_answer, suggested_chart)
-            
-            results.append({
-                "query": query,
-                "status": result.get("status"),
-                "answer": final_answer,
-                "has_sql": bool(result.get("sql_data", {}).get("query")),
-                "has_results": bool(result.get("sql_data", {}).get("results")),
-                "suggested_chart": suggested_chart,
-                "chart_data": chart_data,
-                "error": None
-            })
-        except Exception as e:
-            results.append({
+    for query, result in zip(TEST_QUERIES, probe_results):
+        if isinstance(result, Exception):
+            result = {
                 "query": query,
                 "status": "error",
                 "answer": None,
@@ -195,13 +492,17 @@ async def test_endpoint():
                 "has_results": False,
                 "suggested_chart": None,
                 "chart_data": None,
-                "error": str(e)
-            })
+                "error": str(result)
+            }
+        results.append(result)
     
-    return {
+    response = {
         "status": "success",
         "test_results": results
     }
+    if all(result["status"] == "success" for result in results):
+        await llm_cache.set(cache_key, response, ttl=604800)
+    return response
 
 @app.post("/test-connection")
 async def test_db_connection(connection_data: DatabaseConnection) -> Dict:
@@ -219,6 +520,16 @@ async def test_db_connection(connection_data: DatabaseConnection) -> Dict:
             detail=f"Internal server error: {str(e)}"
         )
 
+@app.post("/test-connections")
+async def test_db_connections(connections: List[DatabaseConnection]) -> Dict:
+    """
+    Test several database connections concurrently
+    """
+    results = await test_connections(connections)
+    return {
+        "status": "success",
+        "results": results
+    }
+
 if __name__ == "__main__":
-    import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,73 @@
+import pytest
+
+for _module in ("pandas", "dotenv", "langchain_core", "langchain_community", "langchain_openai", "tools.query_sql_viz_tool"):
+    pytest.importorskip(_module)
+
+import pandas as pd
+from langchain_db_toolkit import EnhancedDatabaseManager
+
+@pytest.fixture
+def manager():
+    """A manager without a database; the rules below only look at the query and columns"""
+    return EnhancedDatabaseManager.__new__(EnhancedDatabaseManager)
+
+def _original_visualization_type(query, columns):
+    """The rule list _determine_visualization_type replaced, kept as the reference"""
+    query = query.lower()
+    rules = [
+        (lambda q, cols: 'date' in cols and any(x in q for x in ['trend', 'over time', 'monthly', 'daily']), 'line'),
+        (lambda q, cols: 'product' in cols and any(x in q for x in ['compare', 'comparison', 'versus']), 'bar'),
+        (lambda q, cols: 'total_sales' in cols and any(x in q for x in ['distribution', 'proportion', 'share']), 'pie'),
+        (lambda q, cols: 'product' in cols, 'bar'),
+        (lambda q, cols: 'date' in cols, 'line')
+    ]
+    for rule, chart_type in rules:
+        if rule(query, columns):
+            return chart_type
+    return 'bar'
+
+@pytest.mark.parametrize("query", [
+    "Show the distributions of total_sales by region",
+    "Compares sales between regions",
+    "Show comparisons of product sales",
+    "Proportional sales by product",
+    "Plot the trendline of sales",
+    "Is there an uptrend in sales?",
+    "Display the monthly sales trend for Product A in 2023",
+    "Sales over time",
+    "Daily revenue",
+    "Market share of each product",
+    "Product A versus Product B",
+    "Show me total sales by product for 2023"
+])
+@pytest.mark.parametrize("columns", [
+    ["date", "total_sales"],
+    ["product", "total_sales"],
+    ["date", "product", "total_sales"],
+    ["region", "total_sales"]
+])
+def test_visualization_type_matches_original_rules(manager, query, columns):
+    df = pd.DataFrame(columns=columns)
+    assert manager._determine_visualization_type(query, df) == _original_visualization_type(query, columns)
+
+def test_scan_steps_finds_last_sql_query_and_reasoning(manager):
+    from langchain_core.agents import AgentAction
+
+    agent_result = {
+        "output": "Product A sold 100 units.",
+        "intermediate_steps": [
+            (AgentAction(tool="sql_db_list_tables", tool_input="", log=""), "sales"),
+            (AgentAction(tool="sql_db_query", tool_input="SELECT bad", log=""), "Error: syntax error"),
+            (AgentAction(tool="sql_db_query", tool_input={"query": " SELECT product, SUM(amount) FROM sales GROUP BY product "}, log=""), "[('Product A', 100)]")
+        ]
+    }
+
+    sql_query, reasoning = manager._scan_steps(agent_result, include_reasoning=True)
+
+    assert sql_query == "SELECT product, SUM(amount) FROM sales GROUP BY product"
+    assert [step["tool"] for step in reasoning] == ["sql_db_list_tables", "sql_db_query", "sql_db_query"]
+    assert reasoning[1] == {"tool": "sql_db_query", "input": "SELECT bad"}
+    assert manager._scan_steps(agent_result, include_reasoning=False) == (sql_query, [])
+
+def test_scan_steps_without_steps(manager):
+    assert manager._scan_steps({"output": "No data."}, include_reasoning=True) == (None, [])